@@ -7,6 +7,7 @@ import kss
 import json
 import logging
 import torch
+import numpy as np
 from tqdm import tqdm
 import torch.nn.functional as F
 from torch.utils.data import Dataset, DataLoader, random_split
@@ -86,88 +87,46 @@ class DatasetForMLM(Dataset):
 
         return inputs, inputs_mask, labels
 
-class DatasetForAutoRegressive(Dataset):
-    def __init__(self, tokenizer, max_len, dir_path):
+class TokenMemmapDataset(Dataset):
+    """
+    util/token_memmap.py 로 미리 토크나이즈해 둔 토큰 id(int32) 를 memmap 으로 읽어
+    max_len 길이의 구간으로 잘라 반환한다. 학습 중에는 토크나이즈 없이 슬라이스만 한다.
+    """
+    def __init__(self, tokenizer, max_len, token_path):
         logging.info('Start pretraining data load!')
 
         self.tokenizer = tokenizer
-        self.max_len =max_len
-        self.docs = []
-
-        # 파일 리스트
-        file_list = os.listdir(dir_path)
+        self.max_len = max_len
+        self.token_path = token_path
+        self.num_tokens = os.path.getsize(token_path) // np.dtype(np.int32).itemsize
+        # DataLoader worker 에서 처음 접근할 때 memmap 을 연다. (pickle 시 전체 배열이 복사되지 않도록)
+        self.ids = None
 
-        # num_lines = sum(1 for line in open(path, 'r',encoding='utf-8'))
-        file_progress_bar = tqdm(file_list, position=0, leave=True, bar_format='{l_bar}{bar:10}{r_bar}')
-        for file_name in file_progress_bar:
-            path = f'{dir_path}/{file_name}'
-            data_file =  open(path, 'r',encoding='utf-8')
-            for line in tqdm(data_file,
-                             desc='Data load for pretraining',
-                             position=1, leave=True):
-                line = line[:-1]
-                self.docs.append(line)
-        logging.info('Complete data load')
+        logging.info('Complete data load: %s tokens', self.num_tokens)
 
-    def _tokenize_input_ids(self, input_ids: list, add_special_tokens:bool = False, pad_to_max_length: bool = True):
-        inputs = torch.tensor(self.tokenizer.encode(input_ids, add_special_tokens=add_special_tokens, max_length=self.max_len, pad_to_max_length=pad_to_max_length, return_tensors='pt',truncation=True))
-        return inputs
     def __len__(self):
-        return len(self.docs)
+        return self.num_tokens // self.max_len
+
+    def _get_input_ids(self, idx):
+        if self.ids is None:
+            self.ids = np.memmap(self.token_path, dtype=np.int32, mode='r')
+        window = self.ids[idx * self.max_len:(idx + 1) * self.max_len]
+        return torch.from_numpy(window.astype(np.int64))
 
     def __getitem__(self, idx):
-        inputs = self._tokenize_input_ids(self.docs[idx], pad_to_max_length=True)
-        labels = inputs.clone()
+        return self._get_input_ids(idx)
 
-        inputs= inputs.squeeze()
-        labels= labels.squeeze()
+class DatasetForAutoRegressive(TokenMemmapDataset):
+    def __getitem__(self, idx):
+        inputs = self._get_input_ids(idx)
+        labels = inputs.clone()  # shift 는 모델에서 수행
         inputs_mask = inputs != 0
 
-
         return inputs, labels, inputs_mask
 
-class ElectraDataset(Dataset):
-    def __init__(self, tokenizer, max_len, data_path):
-        logging.info('Start pretraining data load!')
-
-        self.tokenizer = tokenizer
-        self.max_len = max_len
-        self.docs = []
-
-        # 파일 리스트
-        file_list = os.listdir(data_path)
-
-        # num_lines = sum(1 for line in open(path, 'r',encoding='utf-8'))
-        file_progress_bar = tqdm(file_list, position=0, leave=True, bar_format='{l_bar}{bar:10}{r_bar}')
-        for file_name in file_progress_bar:
-            path = f'{data_path}/{file_name}'
-            data_file = open(path, 'r', encoding='utf-8')
-            for line in tqdm(data_file,
-                             desc='Data load for pretraining',
-                             position=1, leave=True):
-                line = line[:-1]
-                self.docs.append(line)
-        logging.info('Complete data load')
-
-    def _tokenize_input_ids(self, input_ids: list, pad_to_max_length: bool = True):
-        inputs = torch.tensor(self.tokenizer.encode(input_ids, add_special_tokens=False, max_length=self.max_len, pad_to_max_length=pad_to_max_length, return_tensors='pt',truncation=True))
-        return inputs
-
-    def _pad_token(self, inputs):
-        input_pads = self.max_len - inputs.shape[-1]
-        return F.pad(inputs, pad=(0, input_pads), value=self.tokenizer.pad_token_id)
-
-    def __len__(self):
-        """ Returns the number of documents. """
-        return len(self.docs)
-
-    def __getitem__(self, idx):
-        inputs = self._tokenize_input_ids(self.docs[idx], pad_to_max_length=True)
-        inputs = self._pad_token(inputs)
-
-        inputs= inputs.squeeze()
-
-        return inputs
+class ElectraDataset(TokenMemmapDataset):
+    # 마스킹은 Electra 모델 내부에서 수행하므로 토큰 id 만 반환
+    pass
 
 """
 문장 분리
@@ -2,10 +2,11 @@ import torch
 import torch.nn as nn
 from reformer_pytorch import ReformerLM
 from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
 
 
 class ReformerAutoRegressiveModel(nn.Module):
-    def __init__(self, num_tokens, dim, depth, max_seq_len, heads, causal=True):
+    def __init__(self, num_tokens, dim, depth, max_seq_len, heads, causal=True, use_checkpointing=False):
         super().__init__()
         self.reformer = ReformerLM(
                 num_tokens= num_tokens,
@@ -17,6 +18,17 @@ class ReformerAutoRegressiveModel(nn.Module):
                 return_embeddings=True    # reformer 임베딩을 받기 위한 설정
             )
         self.lm_head = nn.Linear(dim, num_tokens, bias=False)
+        # Reformer 블록은 reversible 이라 역전파 때 activation 을 다시 계산한다.
+        # 남은 큰 activation 은 (batch, seq, vocab) 크기의 loss 계산 부분이므로 이 부분만 checkpoint 한다.
+        self.use_checkpointing = use_checkpointing
+
+    def _lm_loss(self, lm_logits, labels):
+        # Shift so that tokens < n predict n
+        shift_logits = lm_logits[..., :-1, :].contiguous()
+        shift_labels = labels[..., 1:].contiguous()
+        # Flatten the tokens
+        loss_fct = CrossEntropyLoss(ignore_index=0)
+        return loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
 
     def forward(self,input_ids=None,labels=None,**kwargs):
         reformer_outputs = self.reformer(input_ids,**kwargs)
@@ -26,10 +38,8 @@ class ReformerAutoRegressiveModel(nn.Module):
 
         loss = None
         if labels is not None:
-            # Shift so that tokens < n predict n
-            shift_logits = lm_logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            # Flatten the tokens
-            loss_fct = CrossEntropyLoss(ignore_index=0)
-            loss = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+            if self.use_checkpointing and self.training:
+                loss = checkpoint(self._lm_loss, lm_logits, labels, use_reentrant=False)
+            else:
+                loss = self._lm_loss(lm_logits, labels)
         return lm_logits,loss
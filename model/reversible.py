@@ -0,0 +1,38 @@
+import torch
+from reformer_pytorch.reversible import Deterministic
+
+
+class AutocastDeterministic(Deterministic):
+    """
+    reformer_pytorch 의 reversible block 은 backward 에서 f, g 를 다시 계산해 입력을 복원하는데,
+    Deterministic 은 rng 상태만 복원하고 autocast 상태는 복원하지 않는다.
+    backward 는 autocast 밖에서 실행되므로 forward 는 bf16/fp16, 재계산은 fp32 로 수행되어
+    x2 = y2 - g(y1) 로 복원한 activation 이 forward 와 달라지고 오차가 depth 만큼 누적된다.
+    torch.utils.checkpoint 처럼 forward 시점의 autocast 상태를 기록해 두었다가 재계산할 때 다시 적용한다.
+    """
+    gpu_autocast_kwargs = None
+    cpu_autocast_kwargs = None
+
+    def record_rng(self, *args):
+        super().record_rng(*args)
+        self.gpu_autocast_kwargs = {'enabled': torch.is_autocast_enabled(),
+                                    'dtype': torch.get_autocast_gpu_dtype(),
+                                    'cache_enabled': torch.is_autocast_cache_enabled()}
+        self.cpu_autocast_kwargs = {'enabled': torch.is_autocast_cpu_enabled(),
+                                    'dtype': torch.get_autocast_cpu_dtype(),
+                                    'cache_enabled': torch.is_autocast_cache_enabled()}
+
+    def forward(self, *args, record_rng=False, set_rng=False, **kwargs):
+        if not set_rng or self.gpu_autocast_kwargs is None:
+            return super().forward(*args, record_rng=record_rng, set_rng=set_rng, **kwargs)
+
+        with torch.cuda.amp.autocast(**self.gpu_autocast_kwargs), torch.cpu.amp.autocast(**self.cpu_autocast_kwargs):
+            return super().forward(*args, record_rng=record_rng, set_rng=set_rng, **kwargs)
+
+
+def enable_reversible_autocast(model):
+    """ model 안의 모든 reversible block 이 backward 재계산 시 forward 의 autocast 상태를 사용하도록 한다. """
+    for module in model.modules():
+        if type(module) is Deterministic:
+            module.__class__ = AutocastDeterministic
+    return model
@@ -5,21 +5,31 @@ sys.path.append('../')
 
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.data import DataLoader, random_split
+from torch.utils.data.distributed import DistributedSampler
 
 from tqdm import tqdm
 
-from transformers import BertTokenizer
-from fairseq.optim.adafactor import Adafactor
+from transformers import BertTokenizerFast
+from torch.optim import AdamW
 import os
 import json
+import concurrent.futures
+import contextlib
 import logging
 from datetime import datetime
 from dataset.pretrain import ElectraDataset
 from electra_pytorch import Electra
 from reformer_pytorch import ReformerLM
+from util.loader import CUDAPrefetcher, NumpyBatchSampler
+from util.schedule import get_params_without_weight_decay_ln
+from model.reversible import enable_reversible_autocast
 from util.arg import ElectraConfig
 
+logger = logging.getLogger(__name__)
+
 class ElectraTrainer(object):
     def __init__(self,
                  dataset,
@@ -33,7 +43,8 @@ class ElectraTrainer(object):
                  eval_batch_size=None,
                  tb_writer=False,
                  tb_dir='./tb_logs',
-                 log_dir='../logs'):
+                 log_dir='../logs',
+                 compile_model=False):
         self.dataset = dataset
         self.model = model
         self.tokenizer = tokenizer
@@ -42,13 +53,30 @@ class ElectraTrainer(object):
         self.checkpoint_path = checkpoint_path
         self.device = device
         self.n_gpu = torch.cuda.device_count() if torch.cuda.is_available() else 0
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.local_rank = int(os.environ.get('LOCAL_RANK', 0))
         self.train_batch_size = train_batch_size
         self.eval_batch_size = eval_batch_size
         self.tb_writer = tb_writer
         self.log_dir = log_dir
+        self.compile_model = compile_model
+        if compile_model:
+            # LSH attention 은 torch.randn 으로 회전을 뽑고, reversible block 은 backward 에서 rng 상태를 복원해 f, g 를 다시 계산한다.
+            # Inductor 의 기본 난수는 eager 와 달라 (compile 된 forward 와 eager 재계산의 bucket 이 달라져) gradient 가 틀어지므로
+            # compile 된 코드도 eager 와 같은 난수를 사용하도록 한다.
+            import torch._inductor.config
+            torch._inductor.config.fallback_random = True
+        self.eval_model = None
 
         if device is None:
-            self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+            self.device = f'cuda:{self.local_rank}' if torch.cuda.is_available() else 'cpu'
+
+        # Mixed precision: bf16 을 지원하는 GPU(A100/H100 등)는 bf16, 그 외에는 fp16 + GradScaler
+        self.use_amp = torch.cuda.is_available()
+        self.amp_dtype = torch.bfloat16 if self.use_amp and torch.cuda.is_bf16_supported() else torch.float16
+        # Reformer 의 reversible block 이 backward 에서 activation 을 다시 계산할 때도 forward 와 같은 autocast 를 사용하도록 한다.
+        enable_reversible_autocast(self.model)
 
         if eval_batch_size is None:
             self.eval_batch_size = train_batch_size
@@ -57,17 +85,37 @@ class ElectraTrainer(object):
             from torch.utils.tensorboard import SummaryWriter
             self.writer = SummaryWriter(log_dir=tb_dir)
 
-        logging.basicConfig(filename=f'{log_dir}/{self.model_name}-{datetime.now().date()}.log', level=logging.INFO)
+        # 로그/체크포인트 파일 쓰기는 학습 루프를 막지 않도록 하나의 백그라운드 스레드에서 순서대로 처리
+        self._io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._io_futures = []
+
+        # dataset 생성 중 logging.info 호출로 root logger 가 이미 설정되었을 수 있으므로 force 로 다시 설정
+        logging.basicConfig(filename=f'{log_dir}/{self.model_name}-{datetime.now().date()}.log', level=logging.INFO,
+                            format='%(asctime)s | %(message)s', force=True)
 
     def build_dataloaders(self, train_test_split=0.1, train_shuffle=True, eval_shuffle=True):
         dataset_len = len(self.dataset)
         eval_len = int(dataset_len * train_test_split)
         train_len = dataset_len - eval_len
         train_dataset, eval_dataset = random_split(self.dataset, (train_len, eval_len))
-        train_loader = DataLoader(train_dataset, batch_size=self.train_batch_size, shuffle=train_shuffle)
-        eval_loader = DataLoader(eval_dataset, batch_size=self.eval_batch_size, shuffle=eval_shuffle)
-        logging.info(f'''train_dataloader size: {len(train_loader.dataset)} | shuffle: {train_shuffle}
-                         eval_dataloader size: {len(eval_loader.dataset)} | shuffle: {eval_shuffle}''')
+        # worker 프로세스에서 데이터를 미리 읽고, pinned memory 로 GPU 복사를 학습과 겹치게 한다.
+        num_workers = min(8, (os.cpu_count() or 1) // max(1, self.n_gpu))
+        loader_kwargs = {'num_workers': num_workers, 'pin_memory': torch.cuda.is_available()}
+        if num_workers > 0:
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+        # epoch 마다 NumPy 로 한번에 섞은 batch 인덱스를 사용. 분산 학습에서는 rank 별로 서로 다른 batch 를 나누어 학습
+        world_size = dist.get_world_size() if self.distributed else 1
+        train_sampler = NumpyBatchSampler(len(train_dataset), self.train_batch_size, shuffle=train_shuffle,
+                                          seed=torch.initial_seed(), num_replicas=world_size, rank=self.rank)
+        train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, **loader_kwargs)
+        if self.distributed:
+            eval_loader = DataLoader(eval_dataset, batch_size=self.eval_batch_size,
+                                     sampler=DistributedSampler(eval_dataset, shuffle=eval_shuffle), **loader_kwargs)
+        else:
+            eval_loader = DataLoader(eval_dataset, batch_size=self.eval_batch_size, shuffle=eval_shuffle, **loader_kwargs)
+        logger.info('train_dataloader size: %s | shuffle: %s | eval_dataloader size: %s | shuffle: %s',
+                    len(train_loader.dataset), train_shuffle, len(eval_loader.dataset), eval_shuffle)
         return train_loader, eval_loader
     def train(self,
               epochs,
@@ -77,146 +125,247 @@ class ElectraTrainer(object):
               ckpt_steps,
               gradient_accumulation_steps=1):
 
-        optimizer = Adafactor(self.model.parameters())
+        scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp and self.amp_dtype == torch.float16)
         losses = {}
         global_steps = 0
         local_steps = 0
-        step_loss = 0.0
+        step_loss = torch.zeros((), device=self.device)  # log_steps 동안의 loss 합 (GPU)
         start_epoch = 0
         start_step = 0
 
         if os.path.isfile(f'{self.checkpoint_path}/{self.model_name}.pth'):
             checkpoint = torch.load(f'{self.checkpoint_path}/{self.model_name}.pth', map_location=self.device)
-            start_epoch = checkpoint['epoch']
             losses = checkpoint['losses']
             global_steps = checkpoint['train_step']
-            start_step = global_steps if start_epoch==0 else global_steps*self.train_batch_size % len(train_dataloader)
+            # global_steps 는 batch 단위이고 len(train_dataloader) 는 rank 별 epoch 당 batch 수이다.
+            # epoch 의 마지막 step 에 저장된 체크포인트는 다음 epoch 의 처음부터 이어서 학습한다.
+            start_epoch, start_step = divmod(global_steps, len(train_dataloader))
 
             self.model.load_state_dict(checkpoint['model_state_dict'],strict=False)
-            # optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
         self.model.train()
 
-        if self.n_gpu > 1:
-            self.model = nn.DataParallel(self.model)
-            logging.info(f'{datetime.now()} | Utilizing {self.n_gpu} GPUs')
-
         self.model.to(self.device)
-        logging.info(f'{datetime.now()} | Moved model to: {self.device}')
-        logging.info(f'{datetime.now()} | train_batch_size: {self.train_batch_size} | eval_batch_size: {self.eval_batch_size}')
-        logging.info(f'{datetime.now()} | Epochs: {epochs} | log_steps: {log_steps} | ckpt_steps: {ckpt_steps}')
-        logging.info(f'{datetime.now()} | gradient_accumulation_steps: {gradient_accumulation_steps}')
+
+        # fused AdamW 는 파라미터가 GPU 에 있어야 하므로 모델을 옮긴 뒤 생성
+        optimizer = AdamW(get_params_without_weight_decay_ln(self.model.named_parameters(), weight_decay=0.01),
+                          lr=2e-4, eps=1e-8, fused=torch.cuda.is_available())
+        # optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+
+        if self.distributed:
+            self.model = DDP(self.model, device_ids=[self.local_rank], bucket_cap_mb=50)
+            logger.info('Utilizing %s GPUs (rank: %s)', dist.get_world_size(), self.rank)
+
+        if self.compile_model:
+            # 고정된 max_len, batch_size 이므로 CUDA graph 로 캡쳐해 매 step 의 파이썬 오버헤드를 줄인다.
+            self.model = torch.compile(self.model, mode='reduce-overhead', fullgraph=False)
+            logger.info('Compiled model with torch.compile')
+
+        logger.info('Moved model to: %s', self.device)
+        logger.info('train_batch_size: %s | eval_batch_size: %s', self.train_batch_size, self.eval_batch_size)
+        logger.info('Epochs: %s | log_steps: %s | ckpt_steps: %s', epochs, log_steps, ckpt_steps)
+        logger.info('gradient_accumulation_steps: %s', gradient_accumulation_steps)
+
+        # 전체 losses 는 체크포인트에만 저장하고, 로그는 log_steps 마다 한 줄씩 추가(jsonl)
+        results_file = None
+        if self.rank == 0:
+            results_file = open(f'{self.log_dir}/{self.model_name}_train_results.jsonl', 'a', buffering=1 << 20)
 
         for epoch in range(start_epoch, epochs): #tqdm(range(epochs), desc='Epochs', position=0):
-            logging.info(f'{datetime.now()} | Epoch: {epoch}')
-            pb = tqdm(enumerate(train_dataloader),
-                      desc=f'Epoch-{epoch} Iterator',
+            logger.info('Epoch: %s', epoch)
+            epoch_desc = f'Epoch-{epoch} Iterator'
+            if isinstance(train_dataloader.batch_sampler, NumpyBatchSampler):
+                train_dataloader.batch_sampler.set_epoch(epoch)
+            # 다음 배치의 GPU 복사를 현재 step 계산과 겹치도록 별도 stream 에서 미리 수행
+            pb = tqdm(enumerate(CUDAPrefetcher(train_dataloader, self.device)),
+                      desc=epoch_desc,
                       total=len(train_dataloader),
-                      bar_format='{l_bar}{bar:10}{r_bar}'
+                      bar_format='{l_bar}{bar:10}{r_bar}',
+                      disable=self.rank != 0
                       )
             for step, batch in pb:
                 # if step < start_step:
                 #     continue
                 input_data = batch
-                input_data = input_data.to(self.device)
-                output = self.model(input_data)
+                with self._grad_sync(global_steps + 1, gradient_accumulation_steps):
+                    with torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+                        output = self.model(input_data)
 
-                loss = output.loss
-                loss.backward()
+                    loss = output.loss
+                    # gradient accumulation 동안 gradient 가 누적되므로 loss 를 나누어 평균 gradient 로 업데이트
+                    scaler.scale(loss / gradient_accumulation_steps).backward()
 
-                step_loss += loss.item()
-                losses[global_steps] = loss.item()
+                # .item() 은 GPU 동기화를 일으키므로 log_steps 마다 한번만 호출
+                step_loss += loss.detach()
                 local_steps += 1
                 global_steps += 1
 
                 if global_steps % gradient_accumulation_steps == 0:
-                    optimizer.step()
-                    self.model.zero_grad()
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
 
                 if global_steps % log_steps == 0:
-                    if self.tb_writer:
-                        self.writer.add_scalar('Train/Loss', step_loss / local_steps, global_steps)
-                        self.writer.close()
-                    pb.set_postfix_str(f'''{datetime.now()} | Train Loss: {step_loss / local_steps} | Steps: {global_steps}''')
-                    with open(f'{self.log_dir}/{self.model_name}_train_results.json', 'w') as results_file:
-                        json.dump(losses, results_file)
-                        results_file.close()
-                    step_loss = 0.0
+                    if self.rank == 0:
+                        avg_loss = (step_loss / local_steps).item()
+                        losses[global_steps] = avg_loss
+                        pb.set_postfix_str(f'Train Loss: {avg_loss:.4f} | Steps: {global_steps}')
+                        self._submit_io(self._write_train_log, results_file, avg_loss, global_steps)
+                    step_loss.zero_()
                     local_steps = 0
 
-                if global_steps % ckpt_steps == 0:
+                if global_steps % ckpt_steps == 0 and self.rank == 0:
                     self.save(epoch, self.model, optimizer, losses, global_steps)
-                    logging.info(f'{datetime.now()} | Saved checkpoint to: {self.checkpoint_path}')
+                    # 학습이 중단되어도 체크포인트 시점까지의 loss 로그는 남도록 flush
+                    self._submit_io(results_file.flush)
+                    if self.tb_writer:
+                        self._submit_io(self.writer.flush)
 
             # Evaluate every epoch
-            self.evaluate(eval_dataloader)
+            self.evaluate(eval_dataloader, global_steps)
             self.model.train()
             start_step = 0
 
-        self.save(epochs,self.model,optimizer,losses, global_steps)
+        if self.rank == 0:
+            self.save(epochs,self.model,optimizer,losses, global_steps)
+            self._wait_io()
+            results_file.close()
+            if self.tb_writer:
+                self.writer.close()
 
         return self.model
 
-    def evaluate(self, dataloader):
-        if self.n_gpu > 1 and not isinstance(self.model, nn.DataParallel):
-            self.model = nn.DataParallel(self.model)
-
-        self.model.eval()
-
-        eval_loss = 0.0
+    def _grad_sync(self, step, gradient_accumulation_steps):
+        # DDP 는 backward 마다 gradient 를 all-reduce 하므로, optimizer 를 업데이트하지 않는
+        # gradient accumulation 중간 step 에서는 no_sync 로 동기화를 건너뛴다. (gradient 는 로컬에 누적)
+        if self.distributed and step % gradient_accumulation_steps != 0:
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def _get_eval_model(self):
+        # 평가는 gradient 동기화가 필요 없으므로 DDP 로 감싸지 않은 모델을 사용하고,
+        # compile 시에는 학습용 그래프와 별도로 한번만 compile 해서 재사용한다.
+        if self.eval_model is None:
+            model = getattr(self.model, '_orig_mod', self.model)  # torch.compile
+            model = getattr(model, 'module', model)  # DDP
+            if self.compile_model:
+                model = torch.compile(model, mode='reduce-overhead')
+            self.eval_model = model
+        return self.eval_model
+
+    def evaluate(self, dataloader, train_step=0):
+        model = self._get_eval_model()
+        model.eval()
+
+        # step 마다 .item() 으로 GPU 동기화하지 않도록 loss 를 GPU 에서 누적
+        eval_loss = torch.zeros((), device=self.device)
         eval_steps = 0
 
-        logging.info(f'{datetime.now()} | Evaluating...')
+        logger.info('Evaluating...')
         for step, batch in tqdm(enumerate(dataloader),
                                 desc='Evaluating',
                                 leave=True,
                                 total=len(dataloader),
-                                bar_format='{l_bar}{bar:10}{r_bar}'):
+                                bar_format='{l_bar}{bar:10}{r_bar}',
+                                disable=self.rank != 0):
             input_data = batch
-            input_data = input_data.to(self.device)
+            input_data = input_data.to(self.device, non_blocking=True)
 
-            with torch.no_grad():
-                output = self.model(input_data)
+            with torch.inference_mode(), torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+                output = model(input_data)
 
-            tmp_eval_loss = output.loss
+            eval_loss += output.loss.detach()
+            eval_steps += 1
 
-            if self.n_gpu > 1:
-                tmp_eval_loss = tmp_eval_loss.mean()
+        if self.distributed:
+            eval_steps *= dist.get_world_size()
+            dist.all_reduce(eval_loss)
 
-            eval_loss += tmp_eval_loss.item()
-            eval_steps += 1
+        if self.rank != 0 or eval_steps == 0:
+            return None
 
-            total_eval_loss = eval_loss/eval_steps
+        total_eval_loss = (eval_loss / eval_steps).item()
 
-            if self.tb_writer:
-                self.writer.add_scalar('Eval/Loss', eval_loss, eval_steps)
-                self.writer.close()
-            logging.info(f'{datetime.now()} | Step: {step} | Eval Loss: {total_eval_loss}')
-            with open(f'{self.log_dir}/{self.model_name}_eval_results.txt', 'a+') as results_file:
-                results_file.write(f'{datetime.now()} | Step: {step} | Eval Loss: {total_eval_loss}\n')
-                results_file.close()
+        logger.info('Step: %s | Eval Loss: %s', train_step, total_eval_loss)
+        self._submit_io(self._write_eval_log, datetime.now(), total_eval_loss, train_step)
 
         return None
     def save(self, epoch, model, optimizer, losses, train_step):
-        torch.save({
+        model = getattr(model, '_orig_mod', model)  # torch.compile
+        model = getattr(model, 'module', model)  # DDP
+        # 학습이 계속 진행되며 값이 바뀌므로 CPU 로 복사한 뒤 백그라운드 스레드에서 저장
+        checkpoint = {
             'epoch': epoch,  # 현재 학습 epoch
-            'model_state_dict': model.state_dict(),  # 모델 저장
-            'optimizer_state_dict': optimizer.state_dict(),  # 옵티마이저 저장
-            'losses': losses,  # Loss 저장
+            'model_state_dict': _to_cpu(model.state_dict()),  # 모델 저장
+            'optimizer_state_dict': _to_cpu(optimizer.state_dict()),  # 옵티마이저 저장
+            'optimizer_type': type(optimizer).__name__,  # 옵티마이저 종류 (이어서 학습할 때 확인)
+            'losses': dict(losses),  # Loss 저장
             'train_step': train_step,  # 현재 진행한 학습
-        }, f'{self.checkpoint_path}/{self.model_name}.pth')
+        }
+        self._submit_io(self._save_checkpoint, checkpoint)
+
+    def _save_checkpoint(self, checkpoint):
+        # 임시 파일에 저장한 뒤 교체해, 저장 도중에 체크포인트를 읽어도 온전한 파일만 보이도록 한다.
+        path = f'{self.checkpoint_path}/{self.model_name}.pth'
+        tmp_path = f'{path}.tmp'
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+        logger.info('Saved checkpoint to: %s', self.checkpoint_path)
+
+    def _write_train_log(self, results_file, avg_loss, train_step):
+        if self.tb_writer:
+            self.writer.add_scalar('Train/Loss', avg_loss, train_step)
+        results_file.write(json.dumps({'step': train_step, 'loss': avg_loss}) + '\n')
+
+    def _write_eval_log(self, eval_time, eval_loss, train_step):
+        if self.tb_writer:
+            self.writer.add_scalar('Eval/Loss', eval_loss, train_step)
+        with open(f'{self.log_dir}/{self.model_name}_eval_results.txt', 'a+') as results_file:
+            results_file.write(f'{eval_time} | Step: {train_step} | Eval Loss: {eval_loss}\n')
+
+    def _submit_io(self, fn, *args):
+        pending = []
+        for future in self._io_futures:
+            if future.done():
+                future.result()  # 백그라운드에서 발생한 예외는 학습 스레드에서 다시 발생
+            else:
+                pending.append(future)
+        pending.append(self._io_executor.submit(fn, *args))
+        self._io_futures = pending
+
+    def _wait_io(self):
+        # 남은 I/O 를 기다리고, 백그라운드에서 발생한 예외가 있으면 다시 발생시킨다.
+        for future in self._io_futures:
+            future.result()
+        self._io_futures = []
+
+
+def _to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: _to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
 
 
 def main():
     torch.manual_seed(9)
+
+    # torchrun --nproc_per_node=N 으로 실행한 경우 GPU 마다 하나의 프로세스로 분산 학습
+    if 'WORLD_SIZE' in os.environ:
+        dist.init_process_group(backend='nccl', init_method='env://')
+        torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
+
     # 1. Config
     train_config, gen_config, disc_config = ElectraConfig(config_path='../config/electra/electra-train.json').get_config()
 
     # 2. Tokenizer
-    tokenizer = BertTokenizer(vocab_file=train_config.vocab_path, do_lower_case=False)
+    tokenizer = BertTokenizerFast(vocab_file=train_config.vocab_path, do_lower_case=False)
 
     # 3. Dataset
-    dataset = ElectraDataset(tokenizer, train_config.max_len, data_path=train_config.data_path)
+    dataset = ElectraDataset(tokenizer, train_config.max_len, token_path=train_config.token_path)
 
     # 4. Electra Model
     # 4.1. instantiate the generator and discriminator,
@@ -254,7 +403,8 @@ def main():
 
     # 4.3 instantiate electra
     # 엘렉트라 모델 초기화
-    discriminator_with_adapter = nn.Sequential(discriminator, nn.Linear(disc_config.dim, 1))
+    # 디스크리미네이터 hidden state 를 토큰별 점수(scalar)로 투영. sigmoid BCE 는 bias 가 없어도 되므로 bias 연산을 뺀다.
+    discriminator_with_adapter = nn.Sequential(discriminator, nn.Linear(disc_config.dim, 1, bias=False))
 
     model = Electra(
         generator,
@@ -266,7 +416,7 @@ def main():
     )
 
 
-    trainer = ElectraTrainer(dataset, model, tokenizer, train_config.max_len,checkpoint_path=train_config.checkpoint_path, model_name=train_config.model_name, train_batch_size=train_config.batch_size, eval_batch_size=train_config.batch_size)
+    trainer = ElectraTrainer(dataset, model, tokenizer, train_config.max_len,checkpoint_path=train_config.checkpoint_path, model_name=train_config.model_name, train_batch_size=train_config.batch_size, eval_batch_size=train_config.batch_size, compile_model=train_config.compile)
     train_dataloader, eval_dataloader = trainer.build_dataloaders(train_test_split=0.1)
 
     model = trainer.train(epochs=train_config.epochs,
@@ -276,5 +426,8 @@ def main():
                           ckpt_steps=train_config.ckpt_steps,
                           gradient_accumulation_steps=train_config.gradient_accumulation_steps)
 
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
 if __name__ == '__main__':
     main()
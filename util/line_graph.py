@@ -3,9 +3,17 @@ import json
 
 # 라인그래프를 그리기 위한 함수
 def print_json_line_graph(json_path):
-  f = open(json_path, 'r')
-  json_data = json.load(f)
-  lists = json_data.items()  # sorted by key, return a list of tuples
+  with open(json_path, 'r') as f:
+    if json_path.endswith('.jsonl'):
+      # pretrain 의 trainer 가 log_steps 마다 한 줄씩 추가하는 {"step": .., "loss": ..} 로그
+      lists = []
+      for line in f:
+        if line.strip():
+          result = json.loads(line)
+          lists.append((result['step'], result['loss']))
+    else:
+      # {step: loss} 형태의 전체 dict 로그 (mlm-model.py)
+      lists = json.load(f).items()
   lists = list(filter(lambda x: int(x[0]) % 1000==0, lists))
   x, y = zip(*lists)  # unpack a list of pairs into two tuples
 
@@ -16,4 +24,4 @@ def print_json_line_graph(json_path):
   plt.show()
 
 if __name__=='__main__':
-  print_json_line_graph('../logs/electra_train_results.json')
+  print_json_line_graph('../logs/reformer-electra_train_results.jsonl')
@@ -0,0 +1,102 @@
+import numpy as np
+import torch
+
+
+class CUDAPrefetcher(object):
+    """
+    DataLoader 를 감싸 다음 배치의 host -> device 복사를 별도의 CUDA stream 에서 미리 수행한다.
+    (NVIDIA apex 의 data_prefetcher 방식) 현재 step 을 계산하는 동안 다음 배치 복사가 끝나므로 전송 지연이 가려진다.
+    CUDA 가 아닌 device 에서는 단순히 배치를 device 로 옮겨서 반환한다.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        self.iterator = None
+        self.batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def __next__(self):
+        batch = self.next()
+        if batch is None:
+            raise StopIteration
+        return batch
+
+    def _to_device(self, batch):
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._to_device(tensor) for tensor in batch)
+        return batch.to(self.device, non_blocking=True)
+
+    def _record_stream(self, batch):
+        # side stream 에서 할당된 메모리를 default stream 이 사용 중일 때 재사용하지 않도록 표시
+        if isinstance(batch, (list, tuple)):
+            for tensor in batch:
+                self._record_stream(tensor)
+        else:
+            batch.record_stream(torch.cuda.current_stream(self.device))
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+
+        if self.stream is None:
+            self.batch = self._to_device(batch)
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.batch = self._to_device(batch)
+
+    def next(self):
+        if self.iterator is None:
+            iter(self)
+        if self.stream is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self.batch
+        if batch is not None and self.stream is not None:
+            self._record_stream(batch)
+        self.preload()
+        return batch
+
+
+class NumpyBatchSampler(object):
+    """
+    epoch 마다 NumPy 로 전체 인덱스를 한번에 섞어 batch 단위의 인덱스 리스트를 반환하는 batch sampler.
+    (RandomSampler 처럼 인덱스를 하나씩 파이썬 int 로 꺼내지 않는다)
+    분산 학습에서는 모든 rank 가 같은 seed 로 섞은 뒤 서로 다른 batch 를 나누어 가진다. 나머지 샘플은 버린다.
+    """
+    def __init__(self, n, batch_size, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.n = n
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.n // (self.batch_size * self.num_replicas)
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.default_rng(self.seed + self.epoch).permutation(self.n)
+        else:
+            indices = np.arange(self.n)
+
+        num_batches = len(self)
+        indices = indices[:num_batches * self.num_replicas * self.batch_size]
+        batches = indices.reshape(num_batches, self.num_replicas, self.batch_size)[:, self.rank]
+        for batch in batches:
+            yield batch.tolist()
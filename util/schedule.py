@@ -98,3 +98,15 @@ class WarmupCosineWithHardRestartsSchedule(LambdaLR):
         if progress >= 1.0:
             return 0.0
         return max(0.0, 0.5 * (1. + math.cos(math.pi * ((float(self.cycles) * progress) % 1.0))))
+
+
+def get_params_without_weight_decay_ln(named_params, weight_decay):
+    """ Split parameters into two groups so that bias and LayerNorm weights are not decayed.
+        Names are lowercased before matching, so `norm.weight` covers both `LayerNorm.weight` and reformer_pytorch's `norm.weight`.
+    """
+    no_decay = ['bias', 'norm.weight']
+    named_params = list(named_params)
+    return [
+        {'params': [p for n, p in named_params if not any(nd in n.lower() for nd in no_decay)], 'weight_decay': weight_decay},
+        {'params': [p for n, p in named_params if any(nd in n.lower() for nd in no_decay)], 'weight_decay': 0.0},
+    ]
@@ -0,0 +1,50 @@
+import sys
+sys.path.append('../')
+
+import os
+import itertools
+import numpy as np
+from tqdm import tqdm
+from transformers import BertTokenizerFast
+from util.arg import ModelConfig
+
+
+def make_token_memmap(tokenizer, dir_path, token_path, batch_size=10000):
+    """
+    dir_path 의 학습 데이터(한 줄에 한 문서)를 batch_size 줄씩 한번에 토크나이즈해
+    int32 토큰 id 를 token_path(.bin) 에 이어 붙여 저장한다.
+    학습 구간이 여러 문서에 걸칠 수 있으므로 문서 끝마다 [SEP] 토큰을 넣어 경계를 표시한다.
+    """
+    num_tokens = 0
+
+    def write_batch(lines, token_file):
+        input_ids = tokenizer(lines, add_special_tokens=False)['input_ids']
+        token_ids = np.fromiter(itertools.chain.from_iterable(ids + [tokenizer.sep_token_id] for ids in input_ids),
+                                dtype=np.int32)
+        token_ids.tofile(token_file)
+        return len(token_ids)
+
+    with open(token_path, 'wb') as token_file:
+        for file_name in tqdm(os.listdir(dir_path), bar_format='{l_bar}{bar:10}{r_bar}'):
+            lines = []
+            with open(f'{dir_path}/{file_name}', 'r', encoding='utf-8') as data_file:
+                for line in data_file:
+                    lines.append(line[:-1])
+                    if len(lines) == batch_size:
+                        num_tokens += write_batch(lines, token_file)
+                        lines = []
+            if lines:
+                num_tokens += write_batch(lines, token_file)
+
+    return num_tokens
+
+
+if __name__ == '__main__':
+    # 사전학습 config 의 data_path 를 토크나이즈해 token_path 에 저장
+    # ex) python token_memmap.py ../config/electra/electra-train.json
+    config_path = sys.argv[1] if len(sys.argv) > 1 else '../config/autoregressive/autoregressive-pretrain.json'
+    config = ModelConfig(config_path=config_path).get_config()
+
+    tokenizer = BertTokenizerFast(vocab_file=config.vocab_path, do_lower_case=False)
+    num_tokens = make_token_memmap(tokenizer, config.data_path, config.token_path)
+    print(f'{num_tokens} tokens saved to {config.token_path}')